@@ -21,18 +21,57 @@
         If not, see <https://www.gnu.org/licenses/>.
 
 """
+import functools
+import glob
+import hashlib
 import json
 import logging
 import os
+import re
+import shlex
 import shutil
-import stat
 import subprocess
+import sys
+import venv
+from concurrent.futures import ThreadPoolExecutor
 
 from unmanic.libs.unplugins.settings import PluginSettings
 
 # Configure plugin logger
 logger = logging.getLogger("Unmanic.Plugin.postprocessor_script")
 
+# Match any variable in the cmd or args strings. Eg. '{library_id}'
+_VAR_RE = re.compile(r'(\{[a-z_]+\})')
+
+# Arguments that would have been shell syntax before commands were executed without a shell
+_SHELL_OPERATORS = {'|', '||', '&', '&&', ';', '<', '>', '>>', '2>', '2>&1'}
+
+# Bash scripts up to this size are passed inline with 'bash -c' rather than written to a file.
+# Linux limits a single argument to 128KiB, so keep well under that.
+_INLINE_SCRIPT_MAX_BYTES = 64 * 1024
+
+
+@functools.lru_cache(maxsize=None)
+def _which(name):
+    """
+    Return the path to an executable on the PATH.
+    The result is cached as the PATH does not change for the life of the process.
+
+    :param name:
+    :return:
+    """
+    return shutil.which(name)
+
+
+def get_venv_base_python():
+    """
+    Return the path to the Python interpreter that script venvs are built from.
+    This is the interpreter running Unmanic, as the venvs are created in-process.
+
+    :return:
+    """
+    return getattr(sys, '_base_executable', sys.executable)
+
 
 class Settings(PluginSettings):
 
@@ -41,13 +80,22 @@ class Settings(PluginSettings):
         self.settings = {
             'only_on_task_processing_success': False,
             'run_for_each_destination_file':   False,
+            'concurrent_commands':             1,
             'input_type':                      'command',
             'script':                          '',
             'cmd':                             '',
             'args':                            '',
             'script_dependencies':             '',
         }
-        self.form_settings = {
+
+    @functools.cached_property
+    def form_settings(self):
+        """
+        The settings form is only needed by the WebUI. Build it once when first requested rather than for every task.
+
+        :return:
+        """
+        return {
             "only_on_task_processing_success": {
                 "label":       "Only run the command when the all worker processes completed successfully.",
                 "description": "When this is selected, if a worker process fails, then the configured command will not be executed.",
@@ -59,6 +107,7 @@ class Settings(PluginSettings):
                                "file movements meaning we could end up with multiple destination files.\n"
                                "Use this config option to specify if you which this plugin to execute the given command for each of these generated output files.",
             },
+            "concurrent_commands":             self.__set_concurrent_commands_form_settings(),
             "input_type":                      self.__set_input_type_form_settings(),
             "script":                          self.__set_script_form_settings(),
             "cmd":                             self.__set_cmd_form_settings(),
@@ -72,6 +121,22 @@ class Settings(PluginSettings):
             "script_dependencies":             self.__set_script_dependencies_form_settings(),
         }
 
+    def __set_concurrent_commands_form_settings(self):
+        values = {
+            "label":          "Number of output files to run the command for at the same time.",
+            "description":    "Run the command for this many output files in parallel.\n"
+                              "Reduce this if your command is heavy on disk or CPU usage.",
+            "sub_setting":    True,
+            "input_type":     "slider",
+            "slider_options": {
+                "min": 1,
+                "max": 16,
+            },
+        }
+        if not self.get_setting('run_for_each_destination_file'):
+            values["display"] = 'hidden'
+        return values
+
     def __set_input_type_form_settings(self):
         values = {
             "label":          "Execution Type",
@@ -85,20 +150,20 @@ class Settings(PluginSettings):
             ],
         }
         # Add Bash executor if binary exists
-        if shutil.which('bash') is not None:
+        if _which('bash') is not None:
             values["select_options"].append({
                 "value": "bash",
                 "label": "Bash Script",
             })
         # Add Python executor if binary exists
-        python_executable = shutil.which('python3')
-        if python_executable is not None:
+        python_executable = get_venv_base_python()
+        if python_executable and os.path.exists(python_executable):
             values["select_options"].append({
                 "value": "python3",
                 "label": "Python Script ({})".format(python_executable),
             })
         # Add NodeJS executor if binary exists
-        node_executable = shutil.which('node')
+        node_executable = _which('node')
         if node_executable is not None:
             values["select_options"].append({
                 "value": "node",
@@ -149,70 +214,282 @@ class Settings(PluginSettings):
         return values
 
 
+@functools.lru_cache(maxsize=32)
+def get_settings(library_id):
+    """
+    Return the settings object for a library.
+    The object is cached per library. Its configured values are still read from disk on each get_setting() call.
+
+    :param library_id:
+    :return:
+    """
+    return Settings(library_id=library_id)
+
+
 def exec_subprocess(cmd, args, cwd=None):
     """
     Execute a subprocess command
 
+    The command is executed directly without a shell. Both the cmd and args may be given as either a string, which
+    will be split using shell-like syntax, or as a list of arguments.
+
     :param cmd:
     :param args:
     :param cwd:
     :return:
     """
-    full_command = "{} {}".format(cmd, args)
-    if full_command.strip():
+    argv = []
+    for value in (cmd, args):
+        if isinstance(value, str):
+            argv += shlex.split(value)
+        elif value:
+            argv += list(value)
+    if argv:
+        # Resolve bare command names to the executable on the PATH so that the child process can exec it directly
+        if os.sep not in argv[0]:
+            argv[0] = _which(argv[0]) or argv[0]
+
+        full_command = shlex.join(argv)
         logger.debug("Executing command: '{}'.".format(full_command))
 
-        # Execute command
-        process = subprocess.Popen(full_command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                                   universal_newlines=True, errors='replace', shell=True, cwd=cwd)
-
-        # Poll the process for new output until finished
-        while True:
-            line_text = process.stdout.readline()
-            logger.debug(line_text)
-            if line_text == '' and process.poll() is not None:
-                break
+        # Pipes, redirects, etc. are passed to the command as plain arguments. Warn configs written for a shell
+        shell_operators = [arg for arg in argv[1:] if arg in _SHELL_OPERATORS]
+        if shell_operators:
+            logger.warning("Command contains shell syntax {} which is passed to the command as arguments. "
+                           "Commands are not run in a shell. Use a Bash Script or 'bash -c' instead: '{}'."
+                           .format(shell_operators, full_command))
+
+        if logger.isEnabledFor(logging.DEBUG):
+            # Execute command, wait for the process to finish and log the output
+            # The output is read as raw bytes and decoded once, rather than decoding it line by line as it is read
+            process = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=cwd)
+            output = process.communicate()[0]
+            if output:
+                logger.debug(output.decode('utf-8', errors='replace'))
+        else:
+            # The output is not logged. Discard it and block until the process exits
+            process = subprocess.Popen(argv, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=cwd)
+            process.wait()
 
-        # Get the final output and the exit status
-        var = process.communicate()[0]
+        # Check the exit status
         if process.returncode == 0:
             return True
         else:
             raise Exception("Failed to execute command: '{}'".format(full_command))
 
 
+@functools.lru_cache(maxsize=32)
+def parse_template(template):
+    """
+    Split a cmd or args string into a tuple of (is_variable, text) segments.
+    The result is cached as the templates only change when the plugin settings are changed.
+
+    :param template:
+    :return:
+    """
+    # Splitting on a capturing pattern returns the variables at the odd indexes
+    return tuple((index % 2 == 1, text) for index, text in enumerate(_VAR_RE.split(template)) if text)
+
+
+@functools.lru_cache(maxsize=32)
+def split_template(template):
+    """
+    Split a cmd or args string into a tuple of arguments using shell-like syntax.
+    This is done before any variables are substituted so that a value containing spaces or quotes always stays
+    within the argument it was written in.
+
+    :param template:
+    :return:
+    """
+    try:
+        return tuple(shlex.split(template))
+    except ValueError as e:
+        raise Exception("Unable to parse command '{}': {}".format(template, e))
+
+
+def build_argv(template, variable_map):
+    """
+    Split a cmd or args string into a list of arguments and substitute the variables into each one
+
+    :param template:
+    :param variable_map:
+    :return:
+    """
+    return [substitute_variables(arg, variable_map) for arg in split_template(template)]
+
+
+def substitute_variables(template, variable_map):
+    """
+    Substitute all variables in a cmd or args string in a single pass.
+    Unknown variables are left in place.
+
+    :param template:
+    :param variable_map:
+    :return:
+    """
+    parts = []
+    for is_variable, text in parse_template(template):
+        if is_variable and variable_map.get(text) is not None:
+            text = variable_map[text]
+        parts.append(text)
+    return ''.join(parts)
+
+
+def write_file(path, contents, executable=False):
+    """
+    Write a string to a file.
+    Executable files are created with the executable permissions set rather than being changed after writing.
+
+    :param path:
+    :param contents:
+    :param executable:
+    :return:
+    """
+    mode = 0o755 if executable else 0o644
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    try:
+        data = contents.encode('utf-8')
+        while data:
+            data = data[os.write(fd, data):]
+        if executable:
+            # Ensure the permissions are also set when overwriting an existing file
+            os.fchmod(fd, mode)
+    finally:
+        os.close(fd)
+
+
+def get_dependencies_hash(script_dependencies):
+    """
+    Return a hash of the script dependencies file contents.
+    This is used to key cached dependency installations.
+
+    :param script_dependencies:
+    :return:
+    """
+    return hashlib.sha256(script_dependencies.encode('utf-8')).hexdigest()
+
+
+def install_cached_dependencies(install_directory, install):
+    """
+    Ensure that a dependency installation exists in the cache directory.
+    If it does not yet exist, then the given install function is called to build it.
+
+    A marker file is written once the install completes so that an install that was interrupted part way
+    through is not reused. Once installed, any other installs of the same kind left from previous dependencies
+    are removed.
+
+    :param install_directory:
+    :param install:
+    :return:
+    """
+    marker_file = os.path.join(install_directory, ".installed")
+    if os.path.exists(marker_file):
+        return
+
+    # Remove anything left over from a previous install that did not complete
+    shutil.rmtree(install_directory, ignore_errors=True)
+
+    try:
+        install()
+        with open(marker_file, "w"):
+            pass
+    except Exception:
+        # Do not leave a partial install in the cache
+        shutil.rmtree(install_directory, ignore_errors=True)
+        raise
+
+    # Remove installs of the same kind that were built for previous dependencies. Eg. 'venv-<old hash>'
+    prebuilt_directory, install_name = os.path.split(install_directory)
+    install_prefix = "{}-".format(install_name.split('-', 1)[0])
+    for entry in os.listdir(prebuilt_directory):
+        if entry.startswith(install_prefix) and entry != install_name:
+            shutil.rmtree(os.path.join(prebuilt_directory, entry), ignore_errors=True)
+
+
+def prune_wheelhouse(wheels_path, venv_directory):
+    """
+    Remove any wheels from the wheelhouse that are not installed in the given venv
+
+    :param wheels_path:
+    :param venv_directory:
+    :return:
+    """
+    def normalise(name, version):
+        return re.sub(r'[-_.]+', '_', name).lower(), version
+
+    installed = set()
+    for dist_info in glob.glob(os.path.join(venv_directory, "lib", "python*", "site-packages", "*.dist-info")):
+        name, version = os.path.basename(dist_info)[:-len(".dist-info")].split("-", 1)
+        installed.add(normalise(name, version))
+
+    for wheel_file in glob.glob(os.path.join(wheels_path, "*.whl")):
+        name, version = os.path.basename(wheel_file).split("-")[:2]
+        if normalise(name, version) not in installed:
+            os.remove(wheel_file)
+
+
 def get_executable_venv_python(script_dependencies, temp_working_directory, dependency_cache_directory):
     """
     Build a VENV for python
     Install all required dependencies
     Return the updated VENV python executable path
 
+    VENVs are cached against the requirements and the Python interpreter running Unmanic. If one was already built
+    for these it is reused.
+
     :param script_dependencies:
     :param temp_working_directory:
     :param dependency_cache_directory:
     :return:
     """
-    executable = shutil.which('python3')
-
-    # Write dependencies file
-    with open(os.path.join(temp_working_directory, "requirements.txt"), "w") as f:
-        f.write(script_dependencies)
-
-    # Set installation cache path
-    cache_path = os.path.join(dependency_cache_directory, "pip")
-    if not os.path.isdir(cache_path):
-        os.makedirs(cache_path)
-
-    # Create venv and update executable
-    exec_subprocess("{} -m venv venv".format(executable), "", cwd=temp_working_directory)
-    executable = os.path.join(temp_working_directory, "venv", "bin", "python3")
-
-    # Install dependencies
-    os.environ['PIP_CACHE_DIR'] = cache_path
-    exec_subprocess("{} -m pip install -r requirements.txt".format(executable), "", cwd=temp_working_directory)
+    # The venv is tied to the interpreter it was built with, so include that in the cache key along with the
+    # requirements. A venv built for a different Python is then rebuilt rather than reused.
+    interpreter = "{} {}.{}".format(get_venv_base_python(), *sys.version_info[:2])
+    venv_directory = os.path.join(dependency_cache_directory, "prebuilt",
+                                  "venv-{}".format(get_dependencies_hash(interpreter + "\n" + script_dependencies)))
+    venv_executable = os.path.join(venv_directory, "bin", "python3")
+
+    def install():
+        # Write dependencies file
+        write_file(os.path.join(temp_working_directory, "requirements.txt"), script_dependencies)
+
+        # Set installation cache path
+        cache_path = os.path.join(dependency_cache_directory, "pip")
+        os.makedirs(cache_path, exist_ok=True)
+
+        # Create venv. This is done in-process rather than starting another python to run 'python3 -m venv'
+        venv.EnvBuilder(symlinks=True, with_pip=True).create(venv_directory)
+
+        # Install dependencies from the local wheelhouse without hitting the package index.
+        # If any requirements are missing from the wheelhouse, build them into it first and try again.
+        os.environ['PIP_CACHE_DIR'] = cache_path
+        wheels_path = os.path.join(dependency_cache_directory, "wheels")
+        pip_install = [
+            venv_executable, "-m", "pip", "install", "--no-index", "--find-links", wheels_path, "--no-compile",
+            "-r", "requirements.txt",
+        ]
+        process = subprocess.run(pip_install, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                 cwd=temp_working_directory)
+        output = process.stdout.decode('utf-8', errors='replace')
+        if output and logger.isEnabledFor(logging.DEBUG):
+            logger.debug(output)
+        if process.returncode != 0:
+            # Only fall back to fetching from the package index when requirements are missing from the wheelhouse.
+            # Any other failure (eg. conflicting requirements) would fail the same way again.
+            if 'No matching distribution found' not in output:
+                raise Exception("Failed to execute command: '{}'".format(shlex.join(pip_install)))
+            logger.debug("Requirements missing from the local wheelhouse. Fetching them.")
+            exec_subprocess([venv_executable, "-m", "pip", "wheel", "--prefer-binary", "--wheel-dir", wheels_path,
+                             "-r", "requirements.txt"], "", cwd=temp_working_directory)
+            exec_subprocess(pip_install, "", cwd=temp_working_directory)
+
+        # Remove any wheels left from previous requirements
+        prune_wheelhouse(wheels_path, venv_directory)
+
+    install_cached_dependencies(venv_directory, install)
 
     # Return the updated executable
-    return executable
+    return venv_executable
 
 
 def get_executable_node(script_dependencies, temp_working_directory, dependency_cache_directory):
@@ -220,26 +497,45 @@ def get_executable_node(script_dependencies, temp_working_directory, dependency_
     Install all required dependencies
     Return the node executable path
 
+    Installed node modules are cached against the package.json and the node executable. If they were already
+    installed for these they are reused.
+
     :param script_dependencies:
     :param temp_working_directory:
     :param dependency_cache_directory:
     :return:
     """
-    node_executable = shutil.which('node')
-    npm_executable = shutil.which('npm')
-
-    # Write dependencies file
-    with open(os.path.join(temp_working_directory, "package.json"), "w") as f:
-        f.write(script_dependencies)
-
-    # Set installation cache path
-    cache_path = os.path.join(dependency_cache_directory, "node")
-    if not os.path.isdir(cache_path):
-        os.makedirs(cache_path)
-
-    # Install dependencies
-    exec_subprocess("{} install --cache {} --prefer-offline ".format(npm_executable, cache_path), "",
-                    cwd=temp_working_directory)
+    node_executable = _which('node')
+    npm_executable = _which('npm')
+
+    # Native addons are built for a specific node binary, so include that in the cache key along with the
+    # package.json. Modules installed for a different node are then reinstalled rather than reused.
+    node_build = "{} {}".format(os.path.realpath(node_executable), os.stat(node_executable).st_mtime_ns)
+    modules_directory = os.path.join(dependency_cache_directory, "prebuilt",
+                                     "node-{}".format(get_dependencies_hash(node_build + "\n" + script_dependencies)))
+
+    def install():
+        # Set installation cache path
+        cache_path = os.path.join(dependency_cache_directory, "node")
+        os.makedirs(cache_path, exist_ok=True)
+
+        # Install dependencies
+        os.makedirs(modules_directory)
+        write_file(os.path.join(modules_directory, "package.json"), script_dependencies)
+        exec_subprocess([npm_executable, "install", "--cache", cache_path, "--prefer-offline"], "",
+                        cwd=modules_directory)
+
+    install_cached_dependencies(modules_directory, install)
+
+    # Link the installed node modules next to the script. The package.json is also linked as node reads
+    # settings such as the module "type" from the package.json nearest to the script
+    for name in ["node_modules", "package.json"]:
+        link_path = os.path.join(temp_working_directory, name)
+        if os.path.islink(link_path) or os.path.isfile(link_path):
+            os.remove(link_path)
+        elif os.path.isdir(link_path):
+            shutil.rmtree(link_path)
+        os.symlink(os.path.join(modules_directory, name), link_path)
 
     # Return the node executable
     return node_executable
@@ -253,8 +549,7 @@ def get_temp_directory(cache_file_path):
     :return:
     """
     output_directory = os.path.join(os.path.dirname(cache_file_path), 'postprocessor_script')
-    if not os.path.isdir(output_directory):
-        os.makedirs(output_directory)
+    os.makedirs(output_directory, exist_ok=True)
     return output_directory
 
 
@@ -268,29 +563,32 @@ def get_dependency_cache_directory(settings, library_id):
     """
     profile_directory = settings.get_profile_directory()
     output_directory = os.path.join(profile_directory, ".dependency_cache", str(library_id))
-    if not os.path.isdir(output_directory):
-        os.makedirs(output_directory)
+    os.makedirs(output_directory, exist_ok=True)
     return output_directory
 
 
-def build_script(settings, data):
+def build_script(settings, data, configured_settings):
     """
     Export a script to a file and make it executable
+    Return the command to execute the script as a list of arguments
+
+    Bash scripts small enough to be passed as an argument are executed with 'bash -c' without writing them to a file.
 
     :param settings:
     :param data:
+    :param configured_settings:
     :return:
     """
-    input_type = settings.get_setting('input_type')
-    script = settings.get_setting('script')
+    input_type = configured_settings.get('input_type')
+    script = configured_settings.get('script')
     temp_working_directory = get_temp_directory(data.get('final_cache_path'))
-    script_dependencies = settings.get_setting('script_dependencies')
+    script_dependencies = configured_settings.get('script_dependencies')
 
     # We can cache the dependency installation to avoid re-downloading them each time. Fetch the cache directory here
     dependency_cache_directory = get_dependency_cache_directory(settings, data.get('library_id'))
 
     # Build command specific variables
-    executable = shutil.which(input_type)
+    executable = _which(input_type)
     script_extension = "txt"
     if input_type in ['bash']:
         script_extension = "sh"
@@ -301,17 +599,17 @@ def build_script(settings, data):
         script_extension = "js"
         executable = get_executable_node(script_dependencies, temp_working_directory, dependency_cache_directory)
 
-    # Write script to file
     script_path = os.path.join(temp_working_directory, 'script.{}'.format(script_extension))
-    with open(script_path, "w") as f:
-        f.write(script)
 
-    # Make script executable
-    st = os.stat(script_path)
-    os.chmod(script_path, st.st_mode | stat.S_IEXEC)
+    # Pass small Bash scripts inline. No script file exists, so $0 is set to 'bash'
+    if input_type in ['bash'] and len(script.encode('utf-8')) <= _INLINE_SCRIPT_MAX_BYTES:
+        return [executable, "-c", script, "bash"]
+
+    # Write script to an executable file
+    write_file(script_path, script, executable=True)
 
     # Add script to command and return
-    return "{} {}".format(executable, script_path)
+    return [executable, script_path]
 
 
 def on_postprocessor_task_results(data):
@@ -330,28 +628,41 @@ def on_postprocessor_task_results(data):
     :return:
 
     """
-    # Configure settings object
-    settings = Settings(library_id=data.get('library_id'))
+    # Configure settings object and read the configured settings once for this task
+    settings = get_settings(data.get('library_id'))
+    configured_settings = settings.get_setting()
 
-    if settings.get_setting('only_on_task_processing_success'):
+    if configured_settings.get('only_on_task_processing_success'):
         # Ensure all worker task processes completed successfully
         if not data.get('task_processing_success'):
             # The worker task processes did not complete successfully
             return
 
-    cmd = settings.get_setting('cmd')
-    if settings.get_setting('input_type') != 'command':
-        # Generate command to be executed
-        cmd = build_script(settings, data)
-    args = settings.get_setting('args')
-    run_for_each_destination_file = settings.get_setting('run_for_each_destination_file')
+    cmd = configured_settings.get('cmd')
+    script_argv = []
+    script_label = ''
+    if configured_settings.get('input_type') != 'command':
+        # Generate command to execute the script. Variables are not substituted into the script itself
+        script_argv = build_script(settings, data, configured_settings)
+        if script_argv[1:2] == ["-c"]:
+            # Do not log the full contents of an inline script
+            script_label = "{} <script> {}".format(shlex.join(script_argv[:2]), shlex.join(script_argv[3:]))
+        else:
+            script_label = shlex.join(script_argv)
+        cmd = ''
+    args = configured_settings.get('args')
+    run_for_each_destination_file = configured_settings.get('run_for_each_destination_file')
 
     # Remove any line-breaks in args
     args = args.replace('\n', ' ').replace('\r', '')
 
     # Map variables to be replaced in cmd and args
     abspath = data.get('source_data', {}).get('abspath')
-    source_size = os.path.getsize(abspath) if os.path.exists(abspath) else None
+    try:
+        source_size = os.path.getsize(abspath)
+    except OSError:
+        # The source file may have been moved or removed by another plugin
+        source_size = None
     variable_map = {
         '{library_id}':       str(data.get('library_id')),
         '{final_cache_path}': str(data.get('final_cache_path')),
@@ -362,31 +673,50 @@ def on_postprocessor_task_results(data):
     # If this is to be run for each file in the destination files, loop over the 'destination_files' list;
     # Otherwise Just run the command once.
     if run_for_each_destination_file:
+        # Split the cmd and args into arguments once. The variables are substituted into each argument per file
+        argv_template = split_template(cmd) + split_template(args)
+
+        file_commands = []
         for destination_file in data.get('destination_files'):
             # Set the single destination file to the 'output_file_path' mapped variable
             variable_map['{output_file_path}'] = "{}".format(destination_file)
+            file_argv = [substitute_variables(arg, variable_map) for arg in argv_template]
 
-            # Substitute all variables in the cmd and args strings
-            for key in variable_map:
-                value = variable_map.get(key)
-                if value is None:
-                    value = key
-                cmd = cmd.replace(key, value)
-                args = args.replace(key, value)
+            command_line = " ".join(filter(None, [script_label, shlex.join(file_argv)]))
+            file_commands.append((script_argv + file_argv, command_line))
 
-            logger.info("Execute command on single file '{} {}'.".format(cmd, args))
-            exec_subprocess(cmd, args)
+        def exec_file_command(file_command):
+            file_argv, command_line = file_command
+            logger.info("Execute command on single file '{}'.".format(command_line))
+            exec_subprocess(file_argv, "")
+
+        # Each file's command is independent. Run them in parallel up to the configured limit
+        concurrent_commands = min(len(file_commands), int(configured_settings.get('concurrent_commands') or 1))
+        if concurrent_commands > 1:
+            with ThreadPoolExecutor(max_workers=concurrent_commands) as executor:
+                list(executor.map(exec_file_command, file_commands))
+        else:
+            for file_command in file_commands:
+                exec_file_command(file_command)
     else:
+        destination_files = data.get('destination_files', [])
+        command_line = "{} {}".format(cmd, args)
+
         # Set the 'output_files' mapped variable to a JSON dumped object of the 'destination_files' list
-        variable_map['{output_files}'] = "{}".format(json.dumps(data.get('destination_files', [])))
-
-        # Substitute all variables in the cmd and args strings
-        for key in variable_map:
-            value = variable_map.get(key)
-            if value is None:
-                value = key
-            cmd = cmd.replace(key, value)
-            args = args.replace(key, value)
-
-        logger.info("Execute command '{} {}'.".format(cmd, args))
-        exec_subprocess(cmd, args)
+        if '{output_files}' in command_line:
+            variable_map['{output_files}'] = "{}".format(json.dumps(destination_files))
+
+        # Set the 'output_files_json_path' mapped variable to the path of a file containing the same JSON list.
+        # This keeps the command line short no matter how many files were created
+        if '{output_files_json_path}' in command_line:
+            output_files_json_path = os.path.join(get_temp_directory(data.get('final_cache_path')),
+                                                  'output_files.json')
+            write_file(output_files_json_path, json.dumps(destination_files))
+            variable_map['{output_files_json_path}'] = output_files_json_path
+
+        # Substitute all variables into the cmd and args arguments
+        argv = build_argv(cmd, variable_map) + build_argv(args, variable_map)
+
+        command_line = " ".join(filter(None, [script_label, shlex.join(argv)]))
+        logger.info("Execute command '{}'.".format(command_line))
+        exec_subprocess(script_argv + argv, "")